@@ -4,8 +4,9 @@ import multiprocessing as mp
 import os
 import sqlite3
 import time
-from typing import Any, List, Tuple
+from typing import Any, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import tqdm
 from dateutil import parser
@@ -13,6 +14,17 @@ from retry import retry
 
 from c19.file_processing import get_body, read_file
 
+# Sentences vectors are stored as raw bytes into the "vector" BLOB column.
+# Half precision is plenty for cosine similarities, and halves the DB size.
+VECTOR_DTYPE = np.float16
+
+INSERT_COMMANDS = {
+    "articles":
+    "INSERT INTO articles(paper_doi, title, body, abstract, date, sha, folder) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "sentences":
+    "INSERT INTO sentences(article_id, paper_doi, section, sentence_start, sentence_end, sentence, vector) VALUES (?, ?, ?, ?, ?, ?, ?)"
+}
+
 
 def instanciate_sql_db(db_path: str = "articles_database.sqlite") -> None:
     """
@@ -27,13 +39,15 @@ def instanciate_sql_db(db_path: str = "articles_database.sqlite") -> None:
 
     # Storing articles
     articles_table = {
-        "paper_doi": "TEXT PRIMARY KEY",
+        "paper_doi": "TEXT UNIQUE",
         "date": "DATETIME",
         "body": "TEXT",
         "abstract": "TEXT",
         "title": "TEXT",
         "sha": "TEXT",
-        "folder": "TEXT"
+        "folder": "TEXT",
+        # Some articles have no DOI, sentences are linked to this ID instead
+        "article_id": "INTEGER PRIMARY KEY"
     }
     columns = [
         "{0} {1}".format(name, col_type)
@@ -45,11 +59,14 @@ def instanciate_sql_db(db_path: str = "articles_database.sqlite") -> None:
 
     # Storing sentences
     sentences_table = {
+        "article_id": "INTEGER",
         "paper_doi": "TEXT",
         "section": "TEXT",
-        "raw_sentence": "TEXT",
+        # Raw sentence offsets into the section text of the article
+        "sentence_start": "INTEGER",
+        "sentence_end": "INTEGER",
         "sentence": "TEXT",
-        "vector": "TEXT"
+        "vector": "BLOB"
     }
     columns = [
         "{0} {1}".format(name, col_type)
@@ -61,6 +78,32 @@ def instanciate_sql_db(db_path: str = "articles_database.sqlite") -> None:
     database.close()
 
 
+def vector_to_blob(vector: List[float]) -> bytes:
+    """
+    Serialise a sentence vector to be stored into the "vector" column.
+
+    Args:
+        vector (List[float]): The sentence vector.
+
+    Returns:
+        bytes: The raw bytes of the vector.
+    """
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def blob_to_vector(blob: bytes) -> np.ndarray:
+    """
+    Load a sentence vector stored into the "vector" column.
+
+    Args:
+        blob (bytes): The raw bytes of the vector.
+
+    Returns:
+        np.ndarray: The sentence vector (float32).
+    """
+    return np.frombuffer(blob, dtype=VECTOR_DTYPE).astype(np.float32)
+
+
 def get_articles_to_insert(articles_df: pd.DataFrame) -> List[Any]:
     """
     Create a list of articles to be inserted.
@@ -79,29 +122,52 @@ def get_articles_to_insert(articles_df: pd.DataFrame) -> List[Any]:
     return articles
 
 
-@retry(sqlite3.OperationalError, tries=5, delay=2)
 def insert_rows(list_to_insert: List[Any],
                 table_name: str = "articles",
-                db_path: str = "articles_database.sqlite") -> None:
+                db_path: str = "articles_database.sqlite",
+                connection: Optional[sqlite3.Connection] = None) -> None:
     """
     Insert row into the SQLite database. Retry 5 times if database is locked
-    by concurring accesses.
+    by concurring accesses, unless a connection is given.
 
     Args:
         list_to_insert (List[Any]): List of data matching either "articles" or "sentences" table columns.
         table_name (str, optional): The name of the table (articles of sentences). Defaults to "articles".
         db_path (str, optional): Path to the SQLite DB. Defaults to "articles_database.sqlite".
+        connection (sqlite3.Connection, optional): Opened connection to be reused across calls, neither
+            committed nor closed here. Defaults to None (a new connection is opened on db_path).
 
     Raises:
         Exception: Unknown table.
     """
-    if table_name == "articles":
-        command = "INSERT INTO articles(paper_doi, title, body, abstract, date, sha, folder) VALUES (?, ?, ?, ?, ?, ?, ?)"
-    elif table_name == "sentences":
-        command = "INSERT INTO sentences(paper_doi, section, raw_sentence, sentence, vector) VALUES (?, ?, ?, ?, ?)"
-    else:
+    if table_name not in INSERT_COMMANDS:
         raise Exception(f"Unknown table {table_name}")
+    command = INSERT_COMMANDS[table_name]
+
+    if connection is not None:
+        # The statement is prepared once, then reused from the connection cache.
+        # Never retried: executemany is not atomic and SQLite may already have rolled
+        # back the caller's transaction, which has to be rolled back as a whole.
+        connection.executemany(command, list_to_insert)
+        return
+
+    insert_rows_and_commit(list_to_insert=list_to_insert,
+                           command=command,
+                           db_path=db_path)
+
 
+@retry(sqlite3.OperationalError, tries=5, delay=2)
+def insert_rows_and_commit(list_to_insert: List[Any], command: str,
+                           db_path: str) -> None:
+    """
+    Insert rows through a new connection, in their own transaction.
+    Retry 5 times if database is locked by concurring accesses.
+
+    Args:
+        list_to_insert (List[Any]): List of data matching the command placeholders.
+        command (str): The INSERT command.
+        db_path (str): Path to the SQLite DB.
+    """
     connection = sqlite3.connect(db_path)
     cursor = connection.cursor()
     cursor.executemany(command,
@@ -111,6 +177,42 @@ def insert_rows(list_to_insert: List[Any],
     connection.close()
 
 
+def get_bulk_insert_connection(db_path: str = "articles_database.sqlite"
+                               ) -> sqlite3.Connection:
+    """
+    Open a connection tuned for massive insertions: WAL journal and no fsync at each commit.
+    Rows should then be inserted within a single transaction.
+    WAL can be refused (e.g. on network file systems), check it with is_wal_enabled().
+
+    Args:
+        db_path (str, optional): Path to the SQLite DB. Defaults to "articles_database.sqlite".
+
+    Returns:
+        sqlite3.Connection: The opened connection.
+    """
+    connection = sqlite3.connect(db_path)
+    journal_mode = connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if journal_mode != "wal":
+        print(f"WAL journal unavailable for {db_path}, {journal_mode} journal used instead.")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    return connection
+
+
+def is_wal_enabled(connection: sqlite3.Connection) -> bool:
+    """
+    Tell if the DB of a connection uses the WAL journal, which lets readers
+    and a writer access it at the same time.
+
+    Args:
+        connection (sqlite3.Connection): An opened connection.
+
+    Returns:
+        bool: True if the journal mode is WAL.
+    """
+    return connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
 def get_article_text(args: List[Tuple[int, pd.Series, str, str]]) -> None:
     """
     Parse and insert a single article into the SQLite DB. Parallelised method.
@@ -160,27 +262,47 @@ def get_article_text(args: List[Tuple[int, pd.Series, str, str]]) -> None:
 
 
 def get_all_articles_data(
-        db_path: str = "articles_database.sqlite") -> List[str]:
+        db_path: str = "articles_database.sqlite"
+) -> Iterator[Tuple[int, str, str, str, str]]:
+    """
+    Yield all articles data stored in the article table, one at a time.
+
+    Args:
+        db_path (str, optional): Path to the SQLite DB. Defaults to "articles_database.sqlite".
+
+    Yields:
+        Iterator[Tuple[int, str, str, str, str]]: Article data (article_id, paper_doi, title, abstract, body).
+    """
+    connection = sqlite3.connect(db_path)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT article_id, paper_doi, title, abstract, body FROM articles")
+        for article in cursor:
+            yield article
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def count_articles(db_path: str = "articles_database.sqlite") -> int:
     """
-    Return all articles data stored in the article table.
+    Return the number of articles stored in the article table.
 
     Args:
         db_path (str, optional): Path to the SQLite DB. Defaults to "articles_database.sqlite".
 
     Returns:
-        List[str]: List of article data.
+        int: The number of articles.
     """
     connection = sqlite3.connect(db_path)
     cursor = connection.cursor()
-    cursor.execute("SELECT paper_doi, title, abstract, body FROM articles")
-    ids = cursor.fetchall()
+    cursor.execute("SELECT COUNT(*) FROM articles")
+    articles_number = cursor.fetchone()[0]
     cursor.close()
     connection.close()
 
-    # ids_cleaneds = [id_ for id_ in ids if len(id_) == 1 and id_[0] is not None]
-    ids_cleaneds = ids
-
-    return ids_cleaneds
+    return articles_number
 
 
 def create_db_and_load_articles(db_path: str = "articles_database.sqlite",
@@ -247,16 +369,29 @@ def create_db_and_load_articles(db_path: str = "articles_database.sqlite",
 def get_sentences(db_path: str) -> List[Any]:
     """
     Retrieve all sentences from the DB.
+    Raw sentences are extracted from the article section text using their offsets.
 
     Args:
         db_path (str): Path to the DB.
 
     Returns:
-        List[Any]: List of sentences data.
+        List[Any]: List of sentences data (paper_doi, section, raw_sentence, sentence, vector).
     """
     connection = sqlite3.connect(db_path)
     cursor = connection.cursor()
-    command = "SELECT * FROM sentences"
+    command = """
+        SELECT sentences.paper_doi, sentences.section,
+               substr(CASE sentences.section
+                          WHEN 'title' THEN articles.title
+                          WHEN 'abstract' THEN articles.abstract
+                          ELSE articles.body
+                      END,
+                      sentences.sentence_start + 1,
+                      sentences.sentence_end - sentences.sentence_start),
+               sentences.sentence, sentences.vector
+        FROM sentences
+        JOIN articles ON articles.article_id = sentences.article_id
+    """
     cursor.execute(command)
     data = cursor.fetchall()
     cursor.close()
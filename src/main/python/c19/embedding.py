@@ -3,11 +3,19 @@
 import os
 import time
 import urllib.request
-from typing import Any, List
+from contextlib import contextmanager
+from itertools import chain
+from typing import Any, Iterator, List
 
 import numpy as np
+from scipy.sparse import csr_matrix
 from c19.file_processing import read_parquet
 
+try:  # Python >= 3.8
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 
 def get_pre_trained_vectors(file_path: str) -> None:
     """
@@ -38,24 +46,90 @@ class Embedding():
         self.embeddings_dimension = embeddings_dimension
         self.sentence_embedding_method = sentence_embedding_method
         self.vectors = {}
+        self.words_index = {}
+        self.matrix = None
+        self.shared_block = None
 
         self.load_word2vec_vectors()
 
+    def __getstate__(self) -> dict:
+        """
+        When the matrix is in shared memory, only the name of the block is pickled.
+        The self.vectors object is then left out (words are got through self.words_index).
+        """
+        state = self.__dict__.copy()
+        if self.shared_block is not None:
+            state.pop("vectors", None)
+            state["matrix"] = (self.matrix.shape, self.matrix.dtype.str)
+            state["shared_block"] = self.shared_block.name
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """
+        Map the shared memory block (if any) instead of receiving a copy of the matrix.
+        """
+        self.__dict__.update(state)
+        if self.shared_block is not None:
+            shape, dtype = self.matrix
+            self.shared_block = shared_memory.SharedMemory(
+                name=self.shared_block)
+            self.matrix = np.ndarray(shape,
+                                     dtype=dtype,
+                                     buffer=self.shared_block.buf)
+
+    @contextmanager
+    def shared_matrix(self) -> Iterator["Embedding"]:
+        """
+        Move self.matrix into shared memory for the time of the context.
+        Processes receiving the model (pickled) then map the same block instead
+        of getting their own copy. The block is released when leaving the context,
+        the matrix being copied back to private memory.
+        Without multiprocessing.shared_memory (Python < 3.8), nothing is shared.
+        """
+        if shared_memory is None:
+            yield self
+            return
+        self.shared_block = shared_memory.SharedMemory(
+            create=True, size=self.matrix.nbytes)
+        shared = np.ndarray(self.matrix.shape,
+                            dtype=self.matrix.dtype,
+                            buffer=self.shared_block.buf)
+        shared[:] = self.matrix
+        # Release the private matrix, only the shared one is kept meanwhile
+        self.matrix = shared
+        self.vectors = dict(zip(self.words_index.keys(), self.matrix))
+        del shared
+        try:
+            yield self
+        finally:
+            self.matrix = self.matrix.copy()
+            self.vectors = dict(zip(self.words_index.keys(), self.matrix))
+            self.shared_block.close()
+            self.shared_block.unlink()
+            self.shared_block = None
+
     def load_word2vec_vectors(self) -> None:
         """
-        Load word2vec vectors into the self.vectors object.
+        Load word2vec vectors into the self.matrix object (one row per word, indexed by self.words_index).
         Weight each vector object by the TFIDF score of the coresponding token.
+        The self.vectors object maps every word to its row of the matrix.
         """
         tic = time.time()
 
         data_frame = read_parquet(self.parquet_embedding_path)
+        vectors = []
         for word, data in data_frame.iterrows():
+            self.words_index[word] = len(vectors)
             if self.weight_vectors is True:
-                self.vectors[word] = self.get_weighted_vector(
-                    vector=data.vector, coefficient=data.tfidf)
+                vectors.append(
+                    self.get_weighted_vector(vector=data.vector,
+                                             coefficient=data.tfidf))
             else:
-                self.vectors[word] = data.vector
+                vectors.append(data.vector)
         del data_frame
+        self.matrix = np.array(vectors, dtype=np.float32)
+        del vectors
+        self.vectors = dict(zip(self.words_index.keys(), self.matrix))
 
         toc = time.time()
         print(
@@ -80,8 +154,8 @@ class Embedding():
             List[float]: The sentence vector.
         """
         words_vector = [
-            self.vectors[word]
-            if word in self.vectors.keys() else self.get_empty_vector()
+            self.matrix[self.words_index[word]]
+            if word in self.words_index else self.get_empty_vector()
             for word in sentence
         ]
         if self.sentence_embedding_method == "mowe":
@@ -94,6 +168,53 @@ class Embedding():
             )
         return sentence_embedding
 
+    def compute_sentence_vectors_batch(
+            self, sentences: List[List[str]]) -> np.ndarray:
+        """
+        Compute a SOWE/MOWE for a batch of sentences at once. Word skipped if not in model.
+        The batch is represented as a sparse (sentences x words) matrix of words weights
+        (1 or 1 / number of words), multiplied by self.matrix: word vectors are gathered
+        and reduced in a single pass, without copying them (as an "embedding bag").
+
+        Args:
+            sentences (List[List[str]]): The lists of words to be embeded.
+
+        Raises:
+            Exception: The sentence embedding method is different than MOWE or SOWE.
+
+        Returns:
+            np.ndarray: The sentences vectors, one row per sentence. Sentences without
+            any word in the model get a NaN (MOWE) or a zero (SOWE) vector.
+        """
+        if self.sentence_embedding_method not in ["mowe", "sowe"]:
+            raise Exception(
+                f"No such sentence embedding method: {self.sentence_embedding_method}"
+            )
+
+        words_indexes = [[
+            index for index in map(self.words_index.get, sentence)
+            if index is not None
+        ] for sentence in sentences]
+        lengths = np.array([len(indexes) for indexes in words_indexes],
+                           dtype=np.int64)
+        # Start and end of each sentence into the flat list of words
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat_indexes = np.fromiter(chain.from_iterable(words_indexes),
+                                   dtype=np.int64,
+                                   count=int(offsets[-1]))
+        if self.sentence_embedding_method == "mowe":
+            weights = np.repeat(1 / np.maximum(lengths, 1), lengths)
+        else:
+            weights = np.ones(len(flat_indexes))
+        bags = csr_matrix(
+            (weights.astype(self.matrix.dtype), flat_indexes, offsets),
+            shape=(len(sentences), self.matrix.shape[0]))
+        sentences_vectors = np.asarray(bags @ self.matrix)
+        if self.sentence_embedding_method == "mowe":
+            sentences_vectors[lengths == 0] = np.nan
+        return sentences_vectors
+
     def get_weighted_vector(self, vector: List[float],
                             coefficient: float) -> List[float]:
         """
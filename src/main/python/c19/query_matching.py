@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import json
 import multiprocessing as mp
 import os
 import sqlite3
@@ -12,7 +11,7 @@ import numpy as np
 import tqdm
 from sklearn.metrics.pairwise import cosine_similarity
 
-from c19.database_utilities import get_sentences
+from c19.database_utilities import blob_to_vector, get_sentences
 from c19.embedding import Embedding
 from c19.text_preprocessing import preprocess_text
 
@@ -112,7 +111,7 @@ def get_sentences_data(
     for sentence in sentences:
         if sentence[4] is not None:  # If vector
             sentence = list(sentence)
-            sentence[4] = [float(x) for x in json.loads(sentence[4])]
+            sentence[4] = blob_to_vector(sentence[4])
             if np.nansum(
                     sentence[4]) != 0:  # If at least one word has been embeded
                 loaded_sentences.append(sentence)
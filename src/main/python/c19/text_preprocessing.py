@@ -4,18 +4,163 @@ import json
 import multiprocessing as mp
 import os
 import re
-import sqlite3
 import time
-from typing import Any, List, Tuple
-from random import shuffle
+from contextlib import ExitStack, closing
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from random import sample
 
 import tqdm
 from nltk.corpus import stopwords
 from nltk.stem.snowball import SnowballStemmer
-from nltk.tokenize import RegexpTokenizer, sent_tokenize
-from retry import retry
 
-from c19.database_utilities import get_all_articles_data, insert_rows
+try:  # PyStemmer (libstemmer C bindings) is way faster than the NLTK stemmer
+    import Stemmer
+except ImportError:
+    Stemmer = None
+
+try:  # RE2 matches in linear time, with a lower overhead per call than re
+    import re2
+except ImportError:
+    re2 = None
+
+try:  # orjson serialises lists of tokens way faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+from c19.database_utilities import (count_articles, get_all_articles_data,
+                                   get_bulk_insert_connection, insert_rows,
+                                   is_wal_enabled, vector_to_blob)
+
+
+if re2 is not None:
+    # RE2 \w is ASCII only, unicode classes keep the same words as re \w
+    _WORD_RE = re2.compile(r"[\pL\pN_]+")
+else:
+    _WORD_RE = re.compile(r"\w+")
+# Sentences end with a punctuation followed by a space and an upper case letter or a digit
+# (lookarounds are not supported by RE2)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9])")
+# Embedding model and pre-processing options of a pool worker, see init_worker().
+# Defaults are the ones of pre_process_and_vectorize_texts().
+_WORKER_INITIALISED = False
+_EMBEDDING_MODEL = None
+_STEM_WORDS = False
+_REMOVE_NUM = False
+_STOPWORDS = frozenset(stopwords.words("english"))
+if Stemmer is not None:
+    _STEMMER = Stemmer.Stemmer("english")
+else:
+    _STEMMER = SnowballStemmer("english")
+
+
+# Pre-processed tokens, per (stem_words, remove_num) options: {token: word or None if dropped}.
+# Caches are seeded with stopwords, so that a single lookup decides to drop, keep or stem a token.
+_TOKENS_CACHES = {}
+_STOPWORDS_CACHE = dict.fromkeys(_STOPWORDS)
+_TOKENS_CACHE_SIZE = 200000
+_MISSING = object()
+
+
+def stem_word(word: str) -> str:
+    """ Get the root of a word. """
+    if Stemmer is not None:
+        return _STEMMER.stemWord(word)
+    return _STEMMER.stem(word)
+
+
+def preprocess_token(token: str, stem_words: bool,
+                     remove_num: bool) -> Optional[str]:
+    """
+    Pre-process a single lowered token.
+
+    Args:
+        token (str): The token to be pre-processed.
+        stem_words (bool): Stem the token or not.
+        remove_num (bool): Drop the token if numeric (not starting with a letter).
+
+    Returns:
+        Optional[str]: The pre-processed word, or None if it has to be dropped.
+    """
+    if token in _STOPWORDS or len(token) < 2:
+        return None
+    if remove_num is True and not "a" <= token[0] <= "z":
+        return None
+    if stem_words is True:
+        return stem_word(token)
+    return token
+
+
+def dump_words(words: List[str]) -> str:
+    """ Serialise a pre-processed sentence as JSON, to be stored into the "sentence" column. """
+    if orjson is not None:
+        return orjson.dumps(words).decode("utf-8")
+    return json.dumps(words)
+
+
+def get_sentences_spans(text: str) -> List[Tuple[int, int]]:
+    """
+    Split a text into sentences.
+
+    Args:
+        text (str): The text to be split.
+
+    Returns:
+        List[Tuple[int, int]]: The (start, end) offsets of every sentence into the text.
+    """
+    start = len(text) - len(text.lstrip())
+    end = len(text.rstrip())
+    if start >= end:
+        return []
+    spans = []
+    for sentence_end in _SENTENCE_END_RE.finditer(text, start, end):
+        spans.append((start, sentence_end.start()))
+        start = sentence_end.end()
+    spans.append((start, end))
+    return spans
+
+
+def preprocess_text_spans(
+        text: str,
+        stem_words: bool = False,
+        remove_num: bool = True
+) -> Tuple[List[List[str]], List[Tuple[int, int]]]:
+    """
+    Pre-process a text. Remove stop words, lowerise, tokenise, etc.
+    Raw sentences are given as offsets into the text.
+
+    Args:
+        text (str): The text to be pre-processed.
+        stem_words (bool, optional): Stem words or not. Defaults to False.
+        remove_num (bool, optional): Remove numerics values or not. Defaults to True.
+
+    Returns:
+        Tuple[List[List[str]], List[Tuple[int, int]]]: Pre-processed sentences and their (start, end) offsets.
+    """
+    # Lower, tokenise and filter words in a single pass per sentence.
+    # A few tokens make most of the text: they are pre-processed once then got from the cache.
+    # Empty sentences are dropped along with their offsets to keep both lists aligned.
+    cache = _TOKENS_CACHES.get((stem_words, remove_num))
+    if cache is None:
+        cache = _TOKENS_CACHES[(stem_words, remove_num)] = dict(_STOPWORDS_CACHE)
+    pp_sentences = []
+    sentences_spans = []
+    for start, end in get_sentences_spans(text):
+        words = []
+        for token in _WORD_RE.findall(text[start:end].lower()):
+            word = cache.get(token, _MISSING)
+            if word is _MISSING:
+                word = preprocess_token(token, stem_words, remove_num)
+                if len(cache) >= _TOKENS_CACHE_SIZE:
+                    cache.clear()
+                    cache.update(_STOPWORDS_CACHE)
+                cache[token] = word
+            if word is not None:
+                words.append(word)
+        if words:
+            pp_sentences.append(words)
+            sentences_spans.append((start, end))
+    return pp_sentences, sentences_spans
 
 
 def preprocess_text(text: str,
@@ -32,119 +177,113 @@ def preprocess_text(text: str,
     Returns:
         Tuple[List[str], List[str]]: Two lists: raw and pre-processed sentences.
     """
-    word = RegexpTokenizer(r"\w+")
-    stop_words_nltk = set(stopwords.words("english"))
-    stemmer = SnowballStemmer("english")
-
-    def filter_stopwords(sentence: List[str],
-                         stop_words: List[str] = stop_words_nltk) -> List[str]:
-        """ Remove stopwords from a given list of words. """
-        return [word for word in sentence if word not in stop_words]
-
-    def do_stemming(sentence: List[str],
-                    stem_function: Any = stemmer) -> List[str]:
-        """ Get words root for every member of an input list. """
-        return [stem_function.stem(word) for word in sentence]
-
-    def remove_numeric_words(sentence: List[str]) -> List[str]:
-        """ Remove number (items) from a list of words. """
-        letter_pattern = re.compile(r"[a-z]")
-        return [word for word in sentence if letter_pattern.match(word)]
-
-    # Split paragraphs into sentences and keep them for nive output
-    sentences_raw = sent_tokenize(text)
-    # Lower
-    sentences = [sentence.lower() for sentence in sentences_raw]
-    # Split sentences into words and remove punctuation
-    sentences = [word.tokenize(sentence) for sentence in sentences]
-    # Remove stopwords
-    sentences = [filter_stopwords(sentence) for sentence in sentences]
-    if stem_words is True:
-        # Stem words
-        sentences = [do_stemming(sentence) for sentence in sentences]
-    if remove_num is True:
-        sentences = [remove_numeric_words(sentence) for sentence in sentences]
-    # Filter empty sentences and one-letters words
-    sentences = [[word for word in sentence if len(word) > 1]
-                 for sentence in sentences if sentence != []]
-    return sentences, sentences_raw
+    pp_sentences, sentences_spans = preprocess_text_spans(
+        text, stem_words=stem_words, remove_num=remove_num)
+    # Keep raw sentences for nice output
+    sentences_raw = [text[start:end] for start, end in sentences_spans]
+    return pp_sentences, sentences_raw
 
 
-@retry(sqlite3.OperationalError, tries=5, delay=2)
-def pre_process_batch_of_articles(args: List[Any]) -> None:
+def init_worker(embedding_model: Any, stem_words: bool,
+                remove_num: bool) -> None:
     """
-    Apply preprocessing to articles and store result into the SQLite DB.
-    Retry if the select fail due to a locked database.
+    Pool initializer binding the embedding model and pre-processing options once per worker.
+    The embedding matrix is expected to be in shared memory (see Embedding.shared_matrix).
 
     Args:
-        args (List[Any]): The article data to be pre-processed.
-        (batch, index, embedding_model, stem_words, remove_num)
+        embedding_model (Embedding): The embedding model to be used to vectorize sentences.
+        stem_words (bool): Stem words during preprocessing.
+        remove_num (bool): Remove numerical values during preprocessing.
     """
+    global _WORKER_INITIALISED, _EMBEDDING_MODEL, _STEM_WORDS, _REMOVE_NUM
+    _WORKER_INITIALISED = True
+    _EMBEDDING_MODEL = embedding_model
+    _STEM_WORDS = stem_words
+    _REMOVE_NUM = remove_num
+
 
-    embedding_model = args[1]
-    stem_words: bool = args[2]
-    remove_num: bool = args[3]
+def pre_process_batch_of_articles(batch: List[Any]) -> List[List[Any]]:
+    """
+    Apply preprocessing to articles and vectorize their sentences.
+    Embedding model and options are the ones given to init_worker(), which must have been called.
+
+    Args:
+        batch (List[Any]): The article data to be pre-processed.
+
+    Returns:
+        List[List[Any]]: Rows matching the "sentences" table columns.
+    """
+    assert _WORKER_INITIALISED, "init_worker() must be called before pre-processing articles"
+
+    embedding_model = _EMBEDDING_MODEL
+    stem_words: bool = _STEM_WORDS
+    remove_num: bool = _REMOVE_NUM
 
     articles_rows = []
+    sentences_to_embed = []
 
-    for article in args[0]:
+    for article in batch:
 
-        article_id: str = article[0]
-        article_title: str = article[1]
-        article_abstract: str = article[2]
-        article_body: str = article[3]
+        article_id: int = article[0]
+        article_doi: str = article[1]
+        article_title: str = article[2]
+        article_abstract: str = article[3]
+        article_body: str = article[4]
 
         for section, data in zip(
             ["title", "abstract", "body"],
             [article_title, article_abstract, article_body]):
             if data is not None:
-                pp_sentences, sentences_raw = preprocess_text(
+                # Raw sentences are stored as offsets into the article text
+                pp_sentences, sentences_spans = preprocess_text_spans(
                     data, stem_words=stem_words, remove_num=remove_num)
                 if len(pp_sentences) > 0:
                     # Let's randomly select 20 body sentences at the moment (DB is huge).
                     # TODO: Param ?
-                    if section == "body":
-                        temp_list = list(zip(pp_sentences, sentences_raw))
-                        shuffle(temp_list)
-                        pp_sentences, sentences_raw = zip(*temp_list[0:20])
-                        del temp_list
-                    for pp_sentence, raw_sentence in zip(pp_sentences,
-                                                        sentences_raw):
-                        if pp_sentence != []:
-                            if embedding_model is not None:
-                                vector = json.dumps((*map(
-                                    str,
-                                    embedding_model.compute_sentence_vector(
-                                        pp_sentence)), ))
-                            else:
-                                vector = None
-                            try:
-                                row_to_insert = [
-                                    article_id, section, raw_sentence,
-                                    json.dumps(pp_sentence), vector
-                                ]
-                                articles_rows.append(row_to_insert)
-                            except TypeError:  # When all words are not in the model
-                                continue
+                    if section == "body" and len(pp_sentences) > 20:
+                        indexes = sample(range(len(pp_sentences)), 20)
+                        pp_sentences = [pp_sentences[i] for i in indexes]
+                        sentences_spans = [sentences_spans[i] for i in indexes]
+                    for pp_sentence, (start, end) in zip(pp_sentences,
+                                                         sentences_spans):
+                        articles_rows.append([
+                            article_id, article_doi, section, start, end,
+                            dump_words(pp_sentence)
+                        ])
+                        sentences_to_embed.append(pp_sentence)
+
+    # Vectorize all sentences of the batch at once
+    if embedding_model is not None:
+        vectors = embedding_model.compute_sentence_vectors_batch(
+            sentences_to_embed)
+        for row_to_insert, vector in zip(articles_rows, vectors):
+            row_to_insert.append(vector_to_blob(vector))
+    else:
+        for row_to_insert in articles_rows:
+            row_to_insert.append(None)
     return articles_rows
 
 
-def split_into_chunks(iterable, chunks_size=1):
+def split_into_chunks(iterable: Iterable[Any],
+                      chunks_size: int = 1) -> Iterator[List[Any]]:
     """
-    Split an iterable into chunks of size chunks.
+    Split an iterable into chunks of size chunks. Items are consumed lazily.
 
     Args:
-        iterable ([type]): List to split.
+        iterable (Iterable[Any]): Items to split.
         chunks_size (int, optional): Size of each chunk. Defaults to 1.
 
-    Returns:
-        [type]: [description]
+    Yields:
+        Iterator[List[Any]]: The successive chunks (the last one may be smaller).
     """
-    batches = []
-    total_size = len(iterable)
-    for ndx in range(0, total_size, chunks_size):
-        batches.append(iterable[ndx:min(ndx + chunks_size, total_size)])
-    return batches
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == chunks_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def pre_process_and_vectorize_texts(embedding_model: Any,
@@ -168,45 +307,53 @@ def pre_process_and_vectorize_texts(embedding_model: Any,
         print(f"DB {db_path} will be used instead.")
 
     else:
-        # Get all previously inserted IDS as well as a pointer on embedding method
-        articles = [
-            article for article in get_all_articles_data(db_path=db_path)
-        ]
-        batches = split_into_chunks(articles, chunks_size=batch_size)
-        arguments = [(batch, embedding_model, stem_words, remove_num)
-                     for batch in batches]
-        print(
-            f"{len(articles)} files to pre-process ({len(batches)} batches of {len(batches[0])} articles)."
-        )
-        del articles
-
-        # Pre-process articles
-        tic = time.time()
-        pool = mp.Pool(processes=os.cpu_count())
-        batches_to_insert = list(
-            tqdm.tqdm(pool.imap_unordered(pre_process_batch_of_articles,
-                                          arguments),
-                      total=len(arguments),
-                      desc="PRE-PROCESSING: "))
-        toc = time.time()
+        # Articles are streamed from the DB, batch by batch
+        articles_number = count_articles(db_path=db_path)
+        batches_number = -(-articles_number // batch_size)
+        batches = split_into_chunks(get_all_articles_data(db_path=db_path),
+                                    chunks_size=batch_size)
         print(
-            f"Took {round((toc-tic) / 60, 2)} min to pre-process {len(batches_to_insert)} batches of articles."
+            f"{articles_number} files to pre-process ({batches_number} batches of {batch_size} articles)."
         )
-        del arguments
-        time.sleep(0.5)
 
-        # And insert clean as batch as well data
+        # Pre-process articles and insert clean data as soon as a batch is ready,
+        # all batches within a single transaction
         tic = time.time()
         inserted_sentences = 0
-        for article_sentences in tqdm.tqdm(batches_to_insert,
-                                           total=len(batches_to_insert),
-                                           desc="DB INSERTION: "):
-            insert_rows(list_to_insert=article_sentences,
-                        table_name="sentences",
-                        db_path=db_path)
-            inserted_sentences += len(article_sentences)
+        # Send batches by chunks to limit IPC, and renew workers to bound their memory
+        cpus = os.cpu_count() or 1
+        chunks_size = max(1, batches_number // (cpus * 4))
+        with ExitStack() as stack:
+            # Workers share the embedding matrix instead of getting a copy each
+            if embedding_model is not None:
+                stack.enter_context(embedding_model.shared_matrix())
+            # Terminated (and the transaction rolled back) if a worker fails.
+            # Workers renewed by maxtasksperchild inherit the connection but never use it.
+            pool = stack.enter_context(
+                mp.Pool(processes=cpus,
+                        initializer=init_worker,
+                        initargs=(embedding_model, stem_words, remove_num),
+                        maxtasksperchild=64))
+            connection = stack.enter_context(
+                closing(get_bulk_insert_connection(db_path)))
+            if not is_wal_enabled(connection):
+                # Articles can't be read while the transaction writes: read them all first
+                batches = list(batches)
+            connection.execute("BEGIN")
+            for article_sentences in tqdm.tqdm(
+                    pool.imap_unordered(pre_process_batch_of_articles,
+                                        batches,
+                                        chunksize=chunks_size),
+                    total=batches_number,
+                    desc="PRE-PROCESSING: "):
+                insert_rows(list_to_insert=article_sentences,
+                            table_name="sentences",
+                            connection=connection)
+                inserted_sentences += len(article_sentences)
+            pool.close()
+            pool.join()
+            connection.commit()
         toc = time.time()
-        del batches_to_insert
         print(
-            f"Took {round((toc-tic) / 60, 2)} min to insert {inserted_sentences} sentences (SQLite DB: {db_path})."
+            f"Took {round((toc-tic) / 60, 2)} min to pre-process {batches_number} batches of articles and insert {inserted_sentences} sentences (SQLite DB: {db_path})."
         )